@@ -1,57 +1,229 @@
 import os
+import re
+import sys
 import subprocess
-import random
+import itertools
 import time
 import typing as tp
 import asyncio
 
+import aiohttp
+import aiofiles
+
+# Number of pooled keep-alive connections shared by every transfer
+DOWNLOAD_CONCURRENCY = 16
+DNS_CACHE_TTL = 300
+# Seconds allowed to open a connection, and to wait for the next bytes on an open one
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 120
+# The size probe is only a routing hint, so it gets a much shorter budget
+HEAD_TIMEOUT = aiohttp.ClientTimeout(total=10)
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+STREAM_READ_SIZE = 1 << 16
+# Files at least this large are handed to pget instead of being streamed through the session
+PGET_MIN_SIZE = 256 << 20
+# Default number of pget subprocesses allowed to run at the same time (override with PGET_CONCURRENCY)
+DEFAULT_PGET_CONCURRENCY = 4
+
 class Logger:
+    # Per-process counter that keeps markers unique without a random call per Logger
+    _ids = itertools.count()
+
     def __init__(self, marker: str = 'predict-timings'):
-        self.marker = marker + "%s" % random.randint(0, 1000000)
+        self.marker = marker + "%s" % next(self._ids)
+        self.enabled = os.environ.get('PREDICT_TIMINGS', '1').strip().lower() not in ('0', 'false', 'no', 'off', '')
         self.start = time.time()
         self.last = self.start
     
     def log(self, *args):
+        if not self.enabled:
+            return
+
         current_time = time.time()
         elapsed_since_start = current_time - self.start
         elapsed_since_last_log = current_time - self.last
         
-        message = " ".join(str(arg) for arg in args)
+        message = str(args[0]) if len(args) == 1 else " ".join(map(str, args))
         timings = f"{elapsed_since_start:.2f}s since start, {elapsed_since_last_log:.2f}s since last log"
         
-        print(f"{self.marker}: {message} - {timings}")
+        # One write per line instead of print's separate message and newline writes
+        sys.stdout.write(f"{self.marker}: {message} - {timings}\n")
+        sys.stdout.flush()
         self.last = current_time
 
+    def info(self, *args):
+        self.log(*args)
+
+
+# Directory listings keyed by path, stored alongside the directory mtime they were read at
+_listdir_cache: tp.Dict[str, tp.Tuple[int, tp.FrozenSet[str]]] = {}
+
+def list_local_files(local_path):
+    # Adding or removing an entry bumps the directory mtime, so an unchanged mtime means
+    # the cached listing is still valid and a single stat replaces the directory read
+    mtime = os.stat(local_path).st_mtime_ns
+    cached = _listdir_cache.get(local_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with os.scandir(local_path) as entries:
+        local_files = frozenset(entry.name for entry in entries)
+    _listdir_cache[local_path] = (mtime, local_files)
+    return local_files
 
 def check_files_exist(remote_files, local_path):
-    # Get the list of local file names
-    local_files = os.listdir(local_path)
+    # Get the set of local file names
+    local_files = list_local_files(local_path)
     
     # Check if each remote file exists in the local directory
     missing_files = [file for file in remote_files if file not in local_files]
     
     return missing_files
 
-async def download_file_with_pget(remote_path, dest_path):
-    # Create the subprocess
+def _print_output(prefix, line):
+    if line:
+        print(prefix + line.decode(errors='replace'))
+
+async def _stream_lines(stream, prefix):
+    # read() rather than readline(): progress output redraws with '\r' and can exceed readline's 64 KiB limit.
+    # Each '\r' overwrites the terminal line, so only the last redraw before a '\n' is printed
+    current = b''
+    redrawn = b''
+    while True:
+        chunk = await stream.read(STREAM_READ_SIZE)
+        if not chunk:
+            break
+        for piece in re.split(rb'([\r\n])', chunk):
+            if piece == b'\n':
+                _print_output(prefix, current or redrawn)
+                current = redrawn = b''
+            elif piece == b'\r':
+                redrawn = current or redrawn
+                current = b''
+            else:
+                current += piece
+        if len(current) > STREAM_READ_SIZE:
+            # Don't let a separator-free stream grow without bound
+            _print_output(prefix, current)
+            current = redrawn = b''
+    _print_output(prefix, current or redrawn)
+
+def _remove_partial(part_path):
+    # A failed or cancelled transfer shouldn't leave its .part file behind in the weights directory
+    try:
+        os.remove(part_path)
+    except FileNotFoundError:
+        pass
+
+async def download_file_with_pget(remote_path, dest_path, semaphore):
+    # Download next to the destination and only move it into place once pget succeeds,
+    # so an interrupted download never looks like a complete file
+    part_path = dest_path + '.part'
+    try:
+        async with semaphore:
+            # Create the subprocess
+            print("Downloading ", remote_path)
+            process = await asyncio.create_subprocess_exec(
+                'pget', remote_path, part_path,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+
+            try:
+                # Relay output line by line as it arrives, rather than buffering it until pget exits
+                await asyncio.gather(
+                    _stream_lines(process.stdout, '[stdout] '),
+                    _stream_lines(process.stderr, '[stderr] '),
+                    process.wait(),
+                )
+            except BaseException:
+                # Cancelled by a failed sibling, or the output relay itself failed; don't leave this pget running
+                if process.returncode is None:
+                    process.kill()
+                await process.wait()
+                raise
+
+        if process.returncode != 0:
+            raise Exception(f"pget {remote_path} failed with return code {process.returncode}")
+    except BaseException:
+        _remove_partial(part_path)
+        raise
+
+    os.replace(part_path, dest_path)
+
+async def _run_all_or_cancel(coros):
+    # Like asyncio.TaskGroup (unavailable on Python 3.10): the first failure cancels the remaining tasks
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def _prefers_pget(session, remote_path):
+    # pget splits a file into parallel range requests, which beats one stream on multi-GB shards.
+    # Ask for the identity encoding so Content-Length is the size that will land on disk
+    try:
+        async with session.head(
+            remote_path, allow_redirects=True, timeout=HEAD_TIMEOUT, headers={'Accept-Encoding': 'identity'}
+        ) as response:
+            if response.status != 200:
+                return False
+            size = response.content_length
+            return size is not None and size >= PGET_MIN_SIZE and response.headers.get('Accept-Ranges') == 'bytes'
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        # Without a usable probe, stream it; any real problem with the remote surfaces from the GET
+        return False
+
+async def download_file_with_session(session, remote_path, dest_path, pget_semaphore):
+    if await _prefers_pget(session, remote_path):
+        await download_file_with_pget(remote_path, dest_path, pget_semaphore)
+        return
+
+    # Stream the response body to disk so it never sits in memory
     print("Downloading ", remote_path)
-    process = await asyncio.create_subprocess_exec(
-        'pget', remote_path, dest_path,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
+    part_path = dest_path + '.part'
+    async with session.get(remote_path) as response:
+        response.raise_for_status()
+        try:
+            async with aiofiles.open(part_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await f.write(chunk)
+        except BaseException:
+            _remove_partial(part_path)
+            raise
+    os.replace(part_path, dest_path)
 
-    # Wait for the subprocess to finish
-    stdout, stderr = await process.communicate()
+def _pget_concurrency():
+    value = os.environ.get('PGET_CONCURRENCY', '')
+    try:
+        return max(1, int(value))
+    except ValueError:
+        if value:
+            print(f"Ignoring invalid PGET_CONCURRENCY={value!r}, using {DEFAULT_PGET_CONCURRENCY}")
+        return DEFAULT_PGET_CONCURRENCY
 
-    # Print what the subprocess output (if any)
-    if stdout:
-        print(f'[stdout]\n{stdout.decode()}')
-    if stderr:
-        print(f'[stderr]\n{stderr.decode()}')
+async def _download_all(session, jobs):
+    # The connector's limit bounds how many GETs are in flight; the semaphore bounds pget processes
+    pget_semaphore = asyncio.Semaphore(_pget_concurrency())
+    async with session:
+        await _run_all_or_cancel(
+            download_file_with_session(session, url, dest, pget_semaphore) for url, dest in jobs
+        )
+
+def _is_http(remote_path):
+    return remote_path.startswith(("http://", "https://"))
 
 async def download_files_with_pget(remote_path, path, files):
-    await asyncio.gather(*(download_file_with_pget(f"{remote_path}/{file}", f"{path}/{file}") for file in files))
+    jobs = [(f"{remote_path}/{file}", f"{path}/{file}") for file in files]
+
+    # Small files share one keep-alive connection pool; large shards each get their own pget process
+    connector = aiohttp.TCPConnector(limit=DOWNLOAD_CONCURRENCY, ttl_dns_cache=DNS_CACHE_TTL)
+    # No total cap (aiohttp's default is 300s): only give up on connections that can't open or go quiet
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    await _download_all(aiohttp.ClientSession(connector=connector, timeout=timeout), jobs)
 
     # # Run the bash script for each missing file 
     # process = subprocess.Popen(["./src/download-with-pget.sh", remote_path, path, *files])
@@ -63,12 +235,14 @@ def maybe_download_with_pget(
     remote_filenames: tp.Optional[tp.List[str]] = [],
     logger: tp.Optional[Logger] = None):
     """
-    Downloads files from remote_path to path if they are not present in path. File paths are constructed 
-    by concatenating remote_path and remote_filenames. If remote_path is None, files are not downloaded.
+    Downloads files from remote_path to path if they are not present in path. A file counts as present
+    when its name is in path: downloads are written to a .part file and only renamed once complete, so a
+    name there always means a finished transfer. File paths are constructed by concatenating remote_path
+    and remote_filenames. If remote_path is None or remote_filenames is empty, files are not downloaded.
 
     Args:
         path (str): Path to the directory where files should be downloaded
-        remote_path (str): Path to the directory where files should be downloaded from
+        remote_path (str): http(s) URL of the directory where files should be downloaded from
         remote_filenames (List[str]): List of file names to download
         logger (Logger): Logger object to log progress
     
@@ -79,29 +253,34 @@ def maybe_download_with_pget(
 
         maybe_download_with_pget(
             path="models/roberta-base",
-            remote_path="gs://my-bucket/models/roberta-base",
+            remote_path="https://my-bucket.example.com/models/roberta-base",
             remote_filenames=["config.json", "pytorch_model.bin", "tokenizer.json", "vocab.json"],
             logger=logger
         )
     """
-    if remote_path:
-        if not os.path.exists(path):
-            os.makedirs(path, exist_ok=True)
-            missing_files = remote_filenames
-        else:
-            local_files = os.listdir(path)
-            missing_files = check_files_exist(remote_filenames, path)
-
-        if len(missing_files) > 0:
-            print('Downloading weights...')
-            st = time.time()
-            if logger:
-                logger.info(f"Downloading {missing_files} from {remote_path} to {path}")
-            asyncio.run(download_files_with_pget(remote_path, path, missing_files))
-            if logger:
-                logger.info(f"Finished download")
-            print(f"Finished download in {time.time() - st:.2f}s")
+    if not remote_path or not remote_filenames:
+        # Nothing to fetch, so skip the filesystem and the event loop entirely
+        return path
+
+    if not _is_http(remote_path):
+        # pget (and the session) can only fetch URLs, so fail before touching the filesystem
+        raise ValueError(f"remote_path must be an http(s) URL, got {remote_path}")
+
+    # Drop duplicate names, keeping the caller's order
+    remote_filenames = list(dict.fromkeys(remote_filenames))
+
+    os.makedirs(path, exist_ok=True)
+    missing_files = check_files_exist(remote_filenames, path)
 
+    if len(missing_files) > 0:
+        print('Downloading weights...')
+        st = time.time()
+        if logger:
+            logger.info(f"Downloading {missing_files} from {remote_path} to {path}")
+        asyncio.run(download_files_with_pget(remote_path, path, missing_files))
+        if logger:
+            logger.info(f"Finished download")
+        print(f"Finished download in {time.time() - st:.2f}s")
 
     return path
 